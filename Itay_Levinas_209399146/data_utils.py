@@ -50,15 +50,89 @@ def map_data(data):
     n : length of mapped_data
 
     """
-    uniq = list(set(data))
+    uniq = np.unique(data)
 
-    id_dict = {old: new for new, old in enumerate(sorted(uniq))}
-    data = np.array(map(lambda x: id_dict[x], data))
+    id_dict = {old: new for new, old in enumerate(uniq)}
+    data = np.searchsorted(uniq, data)
     n = len(uniq)
 
     return data, id_dict, n
 
 
+def genre_features(movie_ids, genre_flags, v_dict, num_items):
+    """
+    Builds the 0 or 1 valued genre features of the movies listed in v_dict, as a (num_items, num_genres) CSR matrix.
+    genre_flags holds one row of genre flags per entry of the movie_ids series.
+    """
+
+    # check if movie id was listed in ratings file and therefore in mapping dictionary
+    in_dict = movie_ids.isin(list(v_dict)).values
+
+    # genre flags of the listed movies, with their rows moved to the movies' mapped indices
+    genre_mat = sp.coo_matrix(genre_flags[in_dict], dtype=np.float32)
+    v_rows = movie_ids[in_dict].map(v_dict).values
+
+    return sp.coo_matrix((genre_mat.data, (v_rows[genre_mat.row], genre_mat.col)),
+                         shape=(num_items, genre_flags.shape[1])).tocsr()
+
+
+def ml_100k_user_features(users_df, u_dict, num_users, age_scale=1.):
+    """
+    Builds the ml_100k user features of the users listed in u_dict, as a CSR matrix:
+    age divided by age_scale (column 0), gender (column 1) and occupation (binary, one column per occupation).
+    """
+
+    occupation = set(users_df['occupation'].values.tolist())
+
+    gender_dict = {'M': 0., 'F': 1.}
+    occupation_dict = {f: i for i, f in enumerate(occupation, start=2)}
+
+    num_feats = 2 + len(occupation_dict)
+
+    # check if user id was listed in ratings file and therefore in mapping dictionary
+    users_df = users_df[users_df['user id'].isin(list(u_dict)).values]
+    u_rows = users_df['user id'].map(u_dict).values
+    num_listed = u_rows.shape[0]
+
+    u_data = np.concatenate([users_df['age'].values / float(age_scale),
+                             users_df['gender'].map(gender_dict).values,
+                             np.ones(num_listed)])
+    u_cols = np.concatenate([np.zeros(num_listed, dtype=np.int64),
+                             np.ones(num_listed, dtype=np.int64),
+                             users_df['occupation'].map(occupation_dict).values])
+    u_features = sp.coo_matrix((u_data, (np.tile(u_rows, 3), u_cols)),
+                               shape=(num_users, num_feats), dtype=np.float32).tocsr()
+    # male users have a stored gender value of zero
+    u_features.eliminate_zeros()
+
+    return u_features
+
+
+def ml_1m_user_features(users_df, u_dict, num_users):
+    """
+    Builds the ml_1m user features of the users listed in u_dict, as a CSR matrix:
+    one-hot encoding of gender, age, occupation and zip-code, the features' columns laid out one after the other.
+    """
+
+    feat_cols = []
+    num_feats = 0
+    for header in users_df.columns.values[1:]:
+        codes, feats = pd.factorize(users_df[header], sort=True)
+        feat_cols.append(codes + num_feats)
+        num_feats += len(feats)
+
+    # check if user id was listed in ratings file and therefore in mapping dictionary
+    in_dict = users_df['user_id'].isin(list(u_dict)).values
+
+    # one entry per (user, feature) pair, a row of u_cols holds the feature columns of one user
+    u_rows = users_df['user_id'][in_dict].map(u_dict).values
+    u_cols = np.column_stack(feat_cols)[in_dict]
+
+    return sp.coo_matrix((np.ones(u_cols.size, dtype=np.float32),
+                          (np.repeat(u_rows, u_cols.shape[1]), u_cols.ravel())),
+                         shape=(num_users, num_feats)).tocsr()
+
+
 def download_dataset(dataset, files, data_dir):
     """ Downloads dataset if files are not present. """
 
@@ -163,7 +237,7 @@ def load_data(fname, seed=1234, verbose=True):
         u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
         v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
 
-        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int32)
+        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
         ratings = ratings.astype(np.float64)
 
         # Movie features (genres)
@@ -178,13 +252,8 @@ def load_data(fname, seed=1234, verbose=True):
                                names=movie_headers, engine='python')
 
         genre_headers = movie_df.columns.values[6:]
-        num_genres = genre_headers.shape[0]
 
-        v_features = np.zeros((num_items, num_genres), dtype=np.float32)
-        for movie_id, g_vec in zip(movie_df['movie id'].values.tolist(), movie_df[genre_headers].values.tolist()):
-            # Check if movie_id was listed in ratings file and therefore in mapping dictionary
-            if movie_id in v_dict.keys():
-                v_features[v_dict[movie_id], :] = g_vec
+        v_features = genre_features(movie_df['movie id'], movie_df[genre_headers].values, v_dict, num_items)
 
         # User features
 
@@ -194,26 +263,7 @@ def load_data(fname, seed=1234, verbose=True):
         users_df = pd.read_csv(users_file, sep=sep, header=None,
                                names=users_headers, engine='python')
 
-        occupation = set(users_df['occupation'].values.tolist())
-
-        gender_dict = {'M': 0., 'F': 1.}
-        occupation_dict = {f: i for i, f in enumerate(occupation, start=2)}
-
-        num_feats = 2 + len(occupation_dict)
-
-        u_features = np.zeros((num_users, num_feats), dtype=np.float32)
-        for _, row in users_df.iterrows():
-            u_id = row['user id']
-            if u_id in u_dict.keys():
-                # age
-                u_features[u_dict[u_id], 0] = row['age']
-                # gender
-                u_features[u_dict[u_id], 1] = gender_dict[row['gender']]
-                # occupation
-                u_features[u_dict[u_id], occupation_dict[row['occupation']]] = 1.
-
-        u_features = sp.csr_matrix(u_features)
-        v_features = sp.csr_matrix(v_features)
+        u_features = ml_100k_user_features(users_df, u_dict, num_users)
 
     elif fname == 'ml_1m':
 
@@ -246,7 +296,7 @@ def load_data(fname, seed=1234, verbose=True):
         u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
         v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
 
-        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int64)
+        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
         ratings = ratings.astype(np.float32)
 
         # Load movie features
@@ -256,24 +306,9 @@ def load_data(fname, seed=1234, verbose=True):
         movies_df = pd.read_csv(movies_file, sep=sep, header=None,
                                 names=movies_headers, engine='python')
 
-        # Extracting all genres
-        genres = []
-        for s in movies_df['genre'].values:
-            genres.extend(s.split('|'))
-
-        genres = list(set(genres))
-        num_genres = len(genres)
-
-        genres_dict = {g: idx for idx, g in enumerate(genres)}
-
-        # Creating 0 or 1 valued features for all genres
-        v_features = np.zeros((num_items, num_genres), dtype=np.float32)
-        for movie_id, s in zip(movies_df['movie_id'].values.tolist(), movies_df['genre'].values.tolist()):
-            # Check if movie_id was listed in ratings file and therefore in mapping dictionary
-            if movie_id in v_dict.keys():
-                gen = s.split('|')
-                for g in gen:
-                    v_features[v_dict[movie_id], genres_dict[g]] = 1.
+        # Creating 0 or 1 valued features for all genres, one column per genre
+        genre_df = movies_df['genre'].str.get_dummies(sep='|')
+        v_features = genre_features(movies_df['movie_id'], genre_df.values, v_dict, num_items)
 
         # Load user features
         users_file = data_dir + files[2]
@@ -281,29 +316,7 @@ def load_data(fname, seed=1234, verbose=True):
         users_df = pd.read_csv(users_file, sep=sep, header=None,
                                names=users_headers, engine='python')
 
-        # Extracting all features
-        cols = users_df.columns.values[1:]
-
-        cntr = 0
-        feat_dicts = []
-        for header in cols:
-            d = dict()
-            feats = np.unique(users_df[header].values).tolist()
-            d.update({f: i for i, f in enumerate(feats, start=cntr)})
-            feat_dicts.append(d)
-            cntr += len(d)
-
-        num_feats = sum(len(d) for d in feat_dicts)
-
-        u_features = np.zeros((num_users, num_feats), dtype=np.float32)
-        for _, row in users_df.iterrows():
-            u_id = row['user_id']
-            if u_id in u_dict.keys():
-                for k, header in enumerate(cols):
-                    u_features[u_dict[u_id], feat_dicts[k][row[header]]] = 1.
-
-        u_features = sp.csr_matrix(u_features)
-        v_features = sp.csr_matrix(v_features)
+        u_features = ml_1m_user_features(users_df, u_dict, num_users)
 
     elif fname == 'ml_10m':
 
@@ -337,7 +350,7 @@ def load_data(fname, seed=1234, verbose=True):
         u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
         v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
 
-        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int64)
+        u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
         ratings = ratings.astype(np.float32)
 
     else:
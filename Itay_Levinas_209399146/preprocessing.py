@@ -5,24 +5,32 @@ import numpy as np
 import scipy.sparse as sp
 import cPickle as pkl
 import csv
+import hashlib
+import inspect
 import os
 import h5py
 import pandas as pd
+from multiprocessing.pool import ThreadPool
 
 
-from data_utils import load_data, map_data, download_dataset
+from data_utils import load_data, map_data, download_dataset, genre_features, ml_100k_user_features, \
+    ml_1m_user_features
 
 
 def normalize_features(feat):
 
-    degree = np.asarray(feat.sum(1)).flatten()
+    feat_norm = sp.csr_matrix(feat, copy=True)
+
+    # row index of every stored entry, used both for the row sums and for the row scaling
+    rows = np.repeat(np.arange(feat_norm.shape[0]), np.diff(feat_norm.indptr))
+    # bincount returns integers when there are no stored entries, degree has to hold np.inf below
+    degree = np.bincount(rows, weights=feat_norm.data, minlength=feat_norm.shape[0]).astype(np.float64)
 
     # set zeros to inf to avoid dividing by zero
     degree[degree == 0.] = np.inf
 
     degree_inv = 1. / degree
-    degree_inv_mat = sp.diags([degree_inv], [0])
-    feat_norm = degree_inv_mat.dot(feat)
+    feat_norm.data *= degree_inv[rows]
 
     if feat_norm.nnz == 0:
         print('ERROR: normalized adjacency matrix has only zero entries!!!!!')
@@ -31,6 +39,16 @@ def normalize_features(feat):
     return feat_norm
 
 
+def read_h5_dataset(ds, dtype=None):
+    """
+    Reads a whole h5py dataset into a preallocated numpy array with read_direct,
+    converting to dtype (default: the dataset's own dtype) while reading.
+    """
+    out = np.empty(ds.shape, dtype=ds.dtype if dtype is None else dtype)
+    ds.read_direct(out)
+    return out
+
+
 def load_matlab_file(path_file, name_field):
     """
     load '.mat' files
@@ -44,34 +62,72 @@ def load_matlab_file(path_file, name_field):
     ds = db[name_field]
     try:
         if 'ir' in ds.keys():
-            data = np.asarray(ds['data'])
-            ir = np.asarray(ds['ir'])
-            jc = np.asarray(ds['jc'])
+            data = read_h5_dataset(ds['data'])
+            ir = read_h5_dataset(ds['ir'])
+            jc = read_h5_dataset(ds['jc'])
             out = sp.csc_matrix((data, ir, jc)).astype(np.float32)
     except AttributeError:
         # Transpose in case is a dense matrix because of the row- vs column- major ordering between python and matlab
-        out = np.asarray(ds).astype(np.float32).T
+        out = read_h5_dataset(ds, dtype=np.float32).T
 
     db.close()
 
     return out
 
 
+def nonzero_entries(mat):
+    """
+    Returns the row indices, column indices and values of the nonzero entries of a dense or sparse matrix,
+    in row-major order (the order np.where gives for a dense matrix).
+    Sparse matrices are read from their stored entries, without densifying them.
+    """
+    if sp.issparse(mat):
+        # copy, so that dropping zeros and sorting indices leaves the caller's matrix untouched
+        mat = sp.csr_matrix(mat, copy=True)
+        mat.eliminate_zeros()
+        mat.sort_indices()
+        mat = mat.tocoo()
+        return mat.row, mat.col, mat.data
+
+    rows, cols = np.nonzero(mat)
+    return rows, cols, mat[rows, cols]
+
+
 def preprocess_user_item_features(u_features, v_features):
     """
     Creates one big feature matrix out of user features and item features.
     Stacks item features under the user features.
     """
 
-    zero_csr_u = sp.csr_matrix((u_features.shape[0], v_features.shape[1]), dtype=u_features.dtype)
-    zero_csr_v = sp.csr_matrix((v_features.shape[0], u_features.shape[1]), dtype=v_features.dtype)
+    u_features = sp.csr_matrix(u_features)
+    v_features = sp.csr_matrix(v_features)
+    num_u_feats = u_features.shape[1]
+    num_feats = num_u_feats + v_features.shape[1]
 
-    u_features = sp.hstack([u_features, zero_csr_u], format='csr')
-    v_features = sp.hstack([zero_csr_v, v_features], format='csr')
+    # the zero blocks need no storage: user features keep their columns in a wider matrix,
+    # item feature columns are shifted past the user feature columns
+    u_features = sp.csr_matrix((u_features.data, u_features.indices, u_features.indptr),
+                               shape=(u_features.shape[0], num_feats))
+    v_features = sp.csr_matrix((v_features.data, v_features.indices + num_u_feats, v_features.indptr),
+                               shape=(v_features.shape[0], num_feats))
 
     return u_features, v_features
 
 
+def diag_scale(adj, row_scale, col_scale=None):
+    """
+    Computes diag(row_scale) * adj * diag(col_scale) (or only the row scaling if col_scale is None)
+    by multiplying the stored entries of a CSR copy of adj by their row and column factors.
+    """
+
+    adj = adj.tocsr(copy=True)
+    adj.data *= np.repeat(row_scale, np.diff(adj.indptr))
+    if col_scale is not None:
+        adj.data *= col_scale[adj.indices]
+
+    return adj
+
+
 def globally_normalize_bipartite_adjacency(adjacencies, verbose=False, symmetric=True):
     """ Globally Normalizes set of bipartite adjacency matrices """
 
@@ -79,7 +135,7 @@ def globally_normalize_bipartite_adjacency(adjacencies, verbose=False, symmetric
         print('Symmetrically normalizing bipartite adj')
     # degree_u and degree_v are row and column sums of adj+I
 
-    adj_tot = np.sum(adj for adj in adjacencies)
+    adj_tot = sum(adjacencies[1:], adjacencies[0])
     degree_u = np.asarray(adj_tot.sum(1)).flatten()
     degree_v = np.asarray(adj_tot.sum(0)).flatten()
 
@@ -89,16 +145,13 @@ def globally_normalize_bipartite_adjacency(adjacencies, verbose=False, symmetric
 
     degree_u_inv_sqrt = 1. / np.sqrt(degree_u)
     degree_v_inv_sqrt = 1. / np.sqrt(degree_v)
-    degree_u_inv_sqrt_mat = sp.diags([degree_u_inv_sqrt], [0])
-    degree_v_inv_sqrt_mat = sp.diags([degree_v_inv_sqrt], [0])
-
-    degree_u_inv = degree_u_inv_sqrt_mat.dot(degree_u_inv_sqrt_mat)
 
     if symmetric:
-        adj_norm = [degree_u_inv_sqrt_mat.dot(adj).dot(degree_v_inv_sqrt_mat) for adj in adjacencies]
+        adj_norm = [diag_scale(adj, degree_u_inv_sqrt, degree_v_inv_sqrt) for adj in adjacencies]
 
     else:
-        adj_norm = [degree_u_inv.dot(adj) for adj in adjacencies]
+        degree_u_inv = degree_u_inv_sqrt * degree_u_inv_sqrt
+        adj_norm = [diag_scale(adj, degree_u_inv) for adj in adjacencies]
 
     return adj_norm
 
@@ -127,7 +180,7 @@ def create_trainvaltest_split(dataset, seed=1234, testing=False, datasplit_path=
 
     if datasplit_from_file and os.path.isfile(datasplit_path):
         print('Reading dataset splits from file...')
-        with open(datasplit_path) as f:
+        with open(datasplit_path, 'rb') as f:
             num_users, num_items, u_nodes, v_nodes, ratings, u_features, v_features = pkl.load(f)
 
         if verbose:
@@ -140,16 +193,14 @@ def create_trainvaltest_split(dataset, seed=1234, testing=False, datasplit_path=
         num_users, num_items, u_nodes, v_nodes, ratings, u_features, v_features = load_data(dataset, seed=seed,
                                                                                             verbose=verbose)
 
-        with open(datasplit_path, 'w') as f:
-            pkl.dump([num_users, num_items, u_nodes, v_nodes, ratings, u_features, v_features], f)
+        with open(datasplit_path, 'wb') as f:
+            pkl.dump([num_users, num_items, u_nodes, v_nodes, ratings, u_features, v_features], f,
+                     protocol=pkl.HIGHEST_PROTOCOL)
 
-    neutral_rating = -1
+    class_values = np.sort(pd.unique(ratings))
 
-    rating_dict = {r: i for i, r in enumerate(np.sort(np.unique(ratings)).tolist())}
-
-    labels = np.full((num_users, num_items), neutral_rating, dtype=np.int32)
-    labels[u_nodes, v_nodes] = np.array([rating_dict[r] for r in ratings])
-    labels = labels.reshape([-1])
+    # labels[k] is the class of the rating given by user u_nodes[k] to item v_nodes[k]
+    labels = np.searchsorted(class_values, ratings).astype(np.int32)
 
     # number of test and validation edges
     num_test = int(np.ceil(ratings.shape[0] * 0.1))
@@ -160,15 +211,13 @@ def create_trainvaltest_split(dataset, seed=1234, testing=False, datasplit_path=
 
     num_train = ratings.shape[0] - num_val - num_test
 
-    pairs_nonzero = np.array([[u, v] for u, v in zip(u_nodes, v_nodes)])
-
-    idx_nonzero = np.array([u * num_items + v for u, v in pairs_nonzero])
+    pairs_nonzero = np.column_stack([u_nodes, v_nodes])
 
-    train_idx = idx_nonzero[0:num_train]
-    val_idx = idx_nonzero[num_train:num_train + num_val]
-    test_idx = idx_nonzero[num_train + num_val:]
+    # the validation pairs follow the training pairs, so when testing the training set
+    # (training and validation pairs) is a single slice as well
+    train_end = num_train + num_val if testing else num_train
 
-    train_pairs_idx = pairs_nonzero[0:num_train]
+    train_pairs_idx = pairs_nonzero[0:train_end]
     val_pairs_idx = pairs_nonzero[num_train:num_train + num_val]
     test_pairs_idx = pairs_nonzero[num_train + num_val:]
 
@@ -177,23 +226,13 @@ def create_trainvaltest_split(dataset, seed=1234, testing=False, datasplit_path=
     u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # create labels
-    train_labels = labels[train_idx]
-    val_labels = labels[val_idx]
-    test_labels = labels[test_idx]
-
-    if testing:
-        u_train_idx = np.hstack([u_train_idx, u_val_idx])
-        v_train_idx = np.hstack([v_train_idx, v_val_idx])
-        train_labels = np.hstack([train_labels, val_labels])
-        # for adjacency matrix construction
-        train_idx = np.hstack([train_idx, val_idx])
+    train_labels = labels[0:train_end]
+    val_labels = labels[num_train:num_train + num_val]
+    test_labels = labels[num_train + num_val:]
 
     # make training adjacency matrix
-    rating_mx_train = np.zeros(num_users * num_items, dtype=np.float32)
-    rating_mx_train[train_idx] = labels[train_idx].astype(np.float32) + 1.
-    rating_mx_train = sp.csr_matrix(rating_mx_train.reshape(num_users, num_items))
-
-    class_values = np.sort(np.unique(ratings))
+    rating_mx_train = sp.csr_matrix((train_labels.astype(np.float32) + 1., (u_train_idx, v_train_idx)),
+                                    shape=(num_users, num_items))
 
     return u_features, v_features, rating_mx_train, train_labels, u_train_idx, v_train_idx, \
         val_labels, u_val_idx, v_val_idx, test_labels, u_test_idx, v_test_idx, class_values
@@ -224,17 +263,15 @@ def load_data_monti(dataset, testing=False):
     elif dataset == 'douban':
         Wrow = load_matlab_file(path_dataset, 'W_users')
         u_features = Wrow
-        v_features = np.eye(num_items)
+        v_features = sp.identity(num_items, format='csr', dtype=np.float32)
     elif dataset == 'yahoo_music':
         Wcol = load_matlab_file(path_dataset, 'W_tracks')
-        u_features = np.eye(num_users)
+        u_features = sp.identity(num_users, format='csr', dtype=np.float32)
         v_features = Wcol
 
-    u_nodes_ratings = np.where(M)[0]
-    v_nodes_ratings = np.where(M)[1]
-    ratings = M[np.where(M)]
+    u_nodes_ratings, v_nodes_ratings, ratings = nonzero_entries(M)
 
-    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int32)
+    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
     ratings = ratings.astype(np.float64)
 
     u_nodes = u_nodes_ratings
@@ -243,74 +280,69 @@ def load_data_monti(dataset, testing=False):
     print('number of users = ', len(set(u_nodes)))
     print('number of item = ', len(set(v_nodes)))
 
-    neutral_rating = -1  # int(np.ceil(np.float(num_classes)/2.)) - 1
-
     # assumes that ratings_train contains at least one example of every rating type
-    rating_dict = {r: i for i, r in enumerate(np.sort(np.unique(ratings)).tolist())}
+    class_values = np.sort(pd.unique(ratings))
 
-    labels = np.full((num_users, num_items), neutral_rating, dtype=np.int32)
-    labels[u_nodes, v_nodes] = np.array([rating_dict[r] for r in ratings])
+    u_nodes_train, v_nodes_train, _ = nonzero_entries(Otraining)
+    u_nodes_test, v_nodes_test, _ = nonzero_entries(Otest)
 
-    for i in range(len(u_nodes)):
-        assert(labels[u_nodes[i], v_nodes[i]] == rating_dict[ratings[i]])
+    u_nodes_train, v_nodes_train = u_nodes_train.astype(np.int32), v_nodes_train.astype(np.int32)
+    u_nodes_test, v_nodes_test = u_nodes_test.astype(np.int32), v_nodes_test.astype(np.int32)
 
-    labels = labels.reshape([-1])
+    # ratings of the training and test pairs, read from M at their coordinates
+    ratings_train = np.asarray(M[u_nodes_train, v_nodes_train]).ravel()
+    ratings_test = np.asarray(M[u_nodes_test, v_nodes_test]).ravel()
 
-    # number of test and validation edges
+    if __debug__:
+        # every training and test pair is a rated pair of M
+        assert np.all(ratings_train != 0) and np.all(ratings_test != 0)
+
+    labels_train = np.searchsorted(class_values, ratings_train).astype(np.int32)
+    labels_test = np.searchsorted(class_values, ratings_test).astype(np.int32)
 
-    num_train = np.where(Otraining)[0].shape[0]
-    num_test = np.where(Otest)[0].shape[0]
+    # number of test and validation edges
+    num_train = u_nodes_train.shape[0]
+    num_test = u_nodes_test.shape[0]
     num_val = int(np.ceil(num_train * 0.2))
     num_train = num_train - num_val
 
-    pairs_nonzero_train = np.array([[u, v] for u, v in zip(np.where(Otraining)[0], np.where(Otraining)[1])])
-    idx_nonzero_train = np.array([u * num_items + v for u, v in pairs_nonzero_train])
-
-    pairs_nonzero_test = np.array([[u, v] for u, v in zip(np.where(Otest)[0], np.where(Otest)[1])])
-    idx_nonzero_test = np.array([u * num_items + v for u, v in pairs_nonzero_test])
+    pairs_nonzero_train = np.column_stack([u_nodes_train, v_nodes_train])
+    pairs_nonzero_test = np.column_stack([u_nodes_test, v_nodes_test])
 
     # Internally shuffle training set (before splitting off validation set)
-    rand_idx = range(len(idx_nonzero_train))
-    np.random.seed(42)
-    np.random.shuffle(rand_idx)
-    idx_nonzero_train = idx_nonzero_train[rand_idx]
+    rand_idx = np.random.RandomState(42).permutation(len(pairs_nonzero_train))
     pairs_nonzero_train = pairs_nonzero_train[rand_idx]
+    labels_train = labels_train[rand_idx]
 
-    idx_nonzero = np.concatenate([idx_nonzero_train, idx_nonzero_test], axis=0)
     pairs_nonzero = np.concatenate([pairs_nonzero_train, pairs_nonzero_test], axis=0)
-
-    val_idx = idx_nonzero[0:num_val]
-    train_idx = idx_nonzero[num_val:num_train + num_val]
-    test_idx = idx_nonzero[num_train + num_val:]
-
-    assert(len(test_idx) == num_test)
+    labels = np.concatenate([labels_train, labels_test], axis=0)
 
     val_pairs_idx = pairs_nonzero[0:num_val]
     train_pairs_idx = pairs_nonzero[num_val:num_train + num_val]
     test_pairs_idx = pairs_nonzero[num_train + num_val:]
 
+    if __debug__:
+        # the test slice holds exactly the held-out test pairs
+        assert len(test_pairs_idx) == num_test
+
     u_test_idx, v_test_idx = test_pairs_idx.transpose()
     u_val_idx, v_val_idx = val_pairs_idx.transpose()
     u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # create labels
-    train_labels = labels[train_idx]
-    val_labels = labels[val_idx]
-    test_labels = labels[test_idx]
+    val_labels = labels[0:num_val]
+    train_labels = labels[num_val:num_train + num_val]
+    test_labels = labels[num_train + num_val:]
 
     if testing:
-        u_train_idx = np.hstack([u_train_idx, u_val_idx])
-        v_train_idx = np.hstack([v_train_idx, v_val_idx])
-        train_labels = np.hstack([train_labels, val_labels])
-        # for adjacency matrix construction
-        train_idx = np.hstack([train_idx, val_idx])
+        # training pairs followed by the validation pairs, a single copy of each array
+        train_pairs_idx = np.concatenate([train_pairs_idx, val_pairs_idx], axis=0)
+        train_labels = np.concatenate([train_labels, val_labels], axis=0)
+        u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # make training adjacency matrix
-    rating_mx_train = np.zeros(num_users * num_items, dtype=np.float32)
-    rating_mx_train[train_idx] = labels[train_idx].astype(np.float32) + 1.
-    rating_mx_train = sp.csr_matrix(rating_mx_train.reshape(num_users, num_items))
-
-    class_values = np.sort(np.unique(ratings))
+    rating_mx_train = sp.csr_matrix((train_labels.astype(np.float32) + 1., (u_train_idx, v_train_idx)),
+                                    shape=(num_users, num_items))
 
     if u_features is not None:
         u_features = sp.csr_matrix(u_features)
@@ -349,16 +381,15 @@ def load_official_trainvaltest_split(dataset, testing=False):
 
     data_train = pd.read_csv(
         filename_train, sep=sep, header=None,
-        names=['u_nodes', 'v_nodes', 'ratings', 'timestamp'], dtype=dtypes)
+        names=['u_nodes', 'v_nodes', 'ratings', 'timestamp'], dtype=dtypes, engine='c')
 
     data_test = pd.read_csv(
         filename_test, sep=sep, header=None,
-        names=['u_nodes', 'v_nodes', 'ratings', 'timestamp'], dtype=dtypes)
+        names=['u_nodes', 'v_nodes', 'ratings', 'timestamp'], dtype=dtypes, engine='c')
 
-    data_array_train = data_train.as_matrix().tolist()
-    data_array_train = np.array(data_array_train)
-    data_array_test = data_test.as_matrix().tolist()
-    data_array_test = np.array(data_array_test)
+    # the timestamp column is not used
+    data_array_train = data_train[['u_nodes', 'v_nodes', 'ratings']].values
+    data_array_test = data_test[['u_nodes', 'v_nodes', 'ratings']].values
 
     data_array = np.concatenate([data_array_train, data_array_test], axis=0)
 
@@ -369,24 +400,17 @@ def load_official_trainvaltest_split(dataset, testing=False):
     u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
     v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
 
-    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int32)
+    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
     ratings = ratings.astype(np.float64)
 
     u_nodes = u_nodes_ratings
     v_nodes = v_nodes_ratings
 
-    neutral_rating = -1  # int(np.ceil(np.float(num_classes)/2.)) - 1
-
     # assumes that ratings_train contains at least one example of every rating type
-    rating_dict = {r: i for i, r in enumerate(np.sort(np.unique(ratings)).tolist())}
-
-    labels = np.full((num_users, num_items), neutral_rating, dtype=np.int32)
-    labels[u_nodes, v_nodes] = np.array([rating_dict[r] for r in ratings])
+    class_values = np.sort(pd.unique(ratings))
 
-    for i in range(len(u_nodes)):
-        assert(labels[u_nodes[i], v_nodes[i]] == rating_dict[ratings[i]])
-
-    labels = labels.reshape([-1])
+    # labels[k] is the class of the rating given by user u_nodes[k] to item v_nodes[k]
+    labels = np.searchsorted(class_values, ratings).astype(np.int32)
 
     # number of test and validation edges, see cf-nade code
 
@@ -395,60 +419,53 @@ def load_official_trainvaltest_split(dataset, testing=False):
     num_val = int(np.ceil(num_train * 0.2))
     num_train = num_train - num_val
 
-    pairs_nonzero = np.array([[u, v] for u, v in zip(u_nodes, v_nodes)])
-    idx_nonzero = np.array([u * num_items + v for u, v in pairs_nonzero])
-
-    for i in range(len(ratings)):
-        assert(labels[idx_nonzero[i]] == rating_dict[ratings[i]])
+    pairs_nonzero = np.column_stack([u_nodes, v_nodes])
 
-    idx_nonzero_train = idx_nonzero[0:num_train+num_val]
-    idx_nonzero_test = idx_nonzero[num_train+num_val:]
+    if __debug__:
+        # every (user, item) pair carries a single rating
+        idx_nonzero = np.multiply(u_nodes, num_items, dtype=np.int64) + v_nodes
+        assert np.unique(idx_nonzero).shape[0] == idx_nonzero.shape[0]
 
     pairs_nonzero_train = pairs_nonzero[0:num_train+num_val]
     pairs_nonzero_test = pairs_nonzero[num_train+num_val:]
 
+    labels_train = labels[0:num_train+num_val]
+    labels_test = labels[num_train+num_val:]
+
     # Internally shuffle training set (before splitting off validation set)
-    rand_idx = range(len(idx_nonzero_train))
-    np.random.seed(42)
-    np.random.shuffle(rand_idx)
-    idx_nonzero_train = idx_nonzero_train[rand_idx]
+    rand_idx = np.random.RandomState(42).permutation(len(pairs_nonzero_train))
     pairs_nonzero_train = pairs_nonzero_train[rand_idx]
+    labels_train = labels_train[rand_idx]
 
-    idx_nonzero = np.concatenate([idx_nonzero_train, idx_nonzero_test], axis=0)
     pairs_nonzero = np.concatenate([pairs_nonzero_train, pairs_nonzero_test], axis=0)
-
-    val_idx = idx_nonzero[0:num_val]
-    train_idx = idx_nonzero[num_val:num_train + num_val]
-    test_idx = idx_nonzero[num_train + num_val:]
-
-    assert(len(test_idx) == num_test)
+    labels = np.concatenate([labels_train, labels_test], axis=0)
 
     val_pairs_idx = pairs_nonzero[0:num_val]
     train_pairs_idx = pairs_nonzero[num_val:num_train + num_val]
     test_pairs_idx = pairs_nonzero[num_train + num_val:]
 
+    if __debug__:
+        # the test slice holds exactly the held-out test pairs
+        assert len(test_pairs_idx) == num_test
+
     u_test_idx, v_test_idx = test_pairs_idx.transpose()
     u_val_idx, v_val_idx = val_pairs_idx.transpose()
     u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # create labels
-    train_labels = labels[train_idx]
-    val_labels = labels[val_idx]
-    test_labels = labels[test_idx]
+    val_labels = labels[0:num_val]
+    train_labels = labels[num_val:num_train + num_val]
+    test_labels = labels[num_train + num_val:]
 
     if testing:
-        u_train_idx = np.hstack([u_train_idx, u_val_idx])
-        v_train_idx = np.hstack([v_train_idx, v_val_idx])
-        train_labels = np.hstack([train_labels, val_labels])
-        # for adjacency matrix construction
-        train_idx = np.hstack([train_idx, val_idx])
+        # training pairs followed by the validation pairs, a single copy of each array
+        train_pairs_idx = np.concatenate([train_pairs_idx, val_pairs_idx], axis=0)
+        train_labels = np.concatenate([train_labels, val_labels], axis=0)
+        u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # make training adjacency matrix
-    rating_mx_train = np.zeros(num_users * num_items, dtype=np.float32)
-    rating_mx_train[train_idx] = labels[train_idx].astype(np.float32) + 1.
-    rating_mx_train = sp.csr_matrix(rating_mx_train.reshape(num_users, num_items))
-
-    class_values = np.sort(np.unique(ratings))
+    rating_mx_train = sp.csr_matrix((train_labels.astype(np.float32) + 1., (u_train_idx, v_train_idx)),
+                                    shape=(num_users, num_items))
 
     if dataset =='ml_100k':
 
@@ -464,13 +481,8 @@ def load_official_trainvaltest_split(dataset, testing=False):
                                names=movie_headers, engine='python')
 
         genre_headers = movie_df.columns.values[6:]
-        num_genres = genre_headers.shape[0]
 
-        v_features = np.zeros((num_items, num_genres), dtype=np.float32)
-        for movie_id, g_vec in zip(movie_df['movie id'].values.tolist(), movie_df[genre_headers].values.tolist()):
-            # check if movie_id was listed in ratings file and therefore in mapping dictionary
-            if movie_id in v_dict.keys():
-                v_features[v_dict[movie_id], :] = g_vec
+        v_features = genre_features(movie_df['movie id'], movie_df[genre_headers].values, v_dict, num_items)
 
         # user features
 
@@ -480,26 +492,10 @@ def load_official_trainvaltest_split(dataset, testing=False):
         users_df = pd.read_csv(users_file, sep=sep, header=None,
                                names=users_headers, engine='python')
 
-        occupation = set(users_df['occupation'].values.tolist())
-
         age = users_df['age'].values
         age_max = age.max()
 
-        gender_dict = {'M': 0., 'F': 1.}
-        occupation_dict = {f: i for i, f in enumerate(occupation, start=2)}
-
-        num_feats = 2 + len(occupation_dict)
-
-        u_features = np.zeros((num_users, num_feats), dtype=np.float32)
-        for _, row in users_df.iterrows():
-            u_id = row['user id']
-            if u_id in u_dict.keys():
-                # age
-                u_features[u_dict[u_id], 0] = row['age'] / np.float(age_max)
-                # gender
-                u_features[u_dict[u_id], 1] = gender_dict[row['gender']]
-                # occupation
-                u_features[u_dict[u_id], occupation_dict[row['occupation']]] = 1.
+        u_features = ml_100k_user_features(users_df, u_dict, num_users, age_scale=age_max)
 
     elif dataset == 'ml_1m':
 
@@ -510,24 +506,9 @@ def load_official_trainvaltest_split(dataset, testing=False):
         movies_df = pd.read_csv(movies_file, sep=sep, header=None,
                                 names=movies_headers, engine='python')
 
-        # extracting all genres
-        genres = []
-        for s in movies_df['genre'].values:
-            genres.extend(s.split('|'))
-
-        genres = list(set(genres))
-        num_genres = len(genres)
-
-        genres_dict = {g: idx for idx, g in enumerate(genres)}
-
-        # creating 0 or 1 valued features for all genres
-        v_features = np.zeros((num_items, num_genres), dtype=np.float32)
-        for movie_id, s in zip(movies_df['movie_id'].values.tolist(), movies_df['genre'].values.tolist()):
-            # check if movie_id was listed in ratings file and therefore in mapping dictionary
-            if movie_id in v_dict.keys():
-                gen = s.split('|')
-                for g in gen:
-                    v_features[v_dict[movie_id], genres_dict[g]] = 1.
+        # 0 or 1 valued features for all genres, one column per genre
+        genre_df = movies_df['genre'].str.get_dummies(sep='|')
+        v_features = genre_features(movies_df['movie_id'], genre_df.values, v_dict, num_items)
 
         # load user features
         users_file = 'data/' + dataset + '/users.dat'
@@ -535,32 +516,10 @@ def load_official_trainvaltest_split(dataset, testing=False):
         users_df = pd.read_csv(users_file, sep=sep, header=None,
                                names=users_headers, engine='python')
 
-        # extracting all features
-        cols = users_df.columns.values[1:]
-
-        cntr = 0
-        feat_dicts = []
-        for header in cols:
-            d = dict()
-            feats = np.unique(users_df[header].values).tolist()
-            d.update({f: i for i, f in enumerate(feats, start=cntr)})
-            feat_dicts.append(d)
-            cntr += len(d)
-
-        num_feats = sum(len(d) for d in feat_dicts)
-
-        u_features = np.zeros((num_users, num_feats), dtype=np.float32)
-        for _, row in users_df.iterrows():
-            u_id = row['user_id']
-            if u_id in u_dict.keys():
-                for k, header in enumerate(cols):
-                    u_features[u_dict[u_id], feat_dicts[k][row[header]]] = 1.
+        u_features = ml_1m_user_features(users_df, u_dict, num_users)
     else:
         raise ValueError('Invalid dataset option %s' % dataset)
 
-    u_features = sp.csr_matrix(u_features)
-    v_features = sp.csr_matrix(v_features)
-
     print("User features shape: "+str(u_features.shape))
     print("Item features shape: "+str(v_features.shape))
 
@@ -570,26 +529,17 @@ def load_official_trainvaltest_split(dataset, testing=False):
 
 def filter_by_features():
     old_user_f = pd.read_csv(open(os.path.join('data', 'book_crossing_original', 'BX-Users.csv'), 'r'), ';')
-    new_user_f = open(os.path.join('data', 'book_crossing_edited', 'BX-Users_new.csv'), 'w')
-    w = csv.writer(new_user_f)
-    w.writerow(['User-ID', 'Age'])
-    user_dict = {}
-    user_id_new = 0
-    for i in range(old_user_f.shape[0]):
-        if np.isnan(old_user_f.loc[i, 'Age']) or 2 > old_user_f.loc[i, 'Age'] or old_user_f.loc[i, 'Age'] > 100:
-            continue
-        user_dict[old_user_f.loc[i, 'User-ID']] = user_id_new
-        w.writerow([user_id_new, old_user_f.loc[i, 'Age']])
-        user_id_new += 1
-    new_user_f.close()
+    valid_user_f = old_user_f[old_user_f['Age'].between(2, 100)].reset_index(drop=True)
+    user_id_new = valid_user_f.index.values
+    user_dict = dict(zip(valid_user_f['User-ID'].values, user_id_new))
+    new_user_f = pd.DataFrame({'User-ID': user_id_new, 'Age': valid_user_f['Age'].values}, columns=['User-ID', 'Age'])
+    new_user_f.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Users_new.csv'), index=False)
 
     old_book_f = open(os.path.join('data', 'book_crossing_original', 'BX-Books.csv'), 'r')
-    new_book_f = open(os.path.join('data', 'book_crossing_edited', 'BX-Books_new.csv'), 'w')
-    wr = csv.writer(new_book_f)
-    wr.writerow(['ISBN', 'Book-Author', 'Year-Of-Publication'])
+    new_books = []
     isbn_to_idx = {}
     idx = 0
-    for line in old_book_f.readlines():
+    for line in old_book_f:
         try:
             spline = line.split(';')
         except TypeError:
@@ -599,32 +549,26 @@ def filter_by_features():
             continue
 
         try:
-            wr.writerow([idx, spline[2].split('""')[1].decode('utf-8').lower(), spline[3].split('""')[1]])
-            isbn_to_idx[spline[0].split('"')[1]] = idx
-            idx += 1
+            # books whose author name is not plain ascii after decoding are left out
+            author = spline[2].split('""')[1].decode('utf-8').lower().encode('ascii')
         except (UnicodeEncodeError, UnicodeDecodeError):
             continue
+        new_books.append([idx, author, spline[3].split('""')[1]])
+        isbn_to_idx[spline[0].split('"')[1]] = idx
+        idx += 1
     old_book_f.close()
-    new_book_f.close()
+    new_book_f = pd.DataFrame(new_books, columns=['ISBN', 'Book-Author', 'Year-Of-Publication'])
+    new_book_f.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Books_new.csv'), index=False)
 
-    valid_books = isbn_to_idx.keys()
-    valid_users = user_dict.keys()
-    users_left = set()
-    items_left = set()
-    ratings = 0
     old_matrix_f = pd.read_csv(open(os.path.join('data', 'book_crossing_original', 'BX-Book-Ratings.csv'), 'r'), ';')
-    new_matrix_f = open(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_new.csv'), 'w')
-    wrt = csv.writer(new_matrix_f)
-    wrt.writerow(['User_Idx', 'Book_Idx', 'Book-Rating'])
-    for i in range(old_matrix_f.shape[0]):
-        if all([old_matrix_f.loc[i, 'ISBN'] in valid_books, old_matrix_f.loc[i, 'User-ID'] in valid_users,
-                old_matrix_f.loc[i, 'Book-Rating']]):
-            wrt.writerow([user_dict[old_matrix_f.loc[i, 'User-ID']], isbn_to_idx[old_matrix_f.loc[i, 'ISBN']],
-                          old_matrix_f.loc[i, 'Book-Rating']])
-            users_left.add(old_matrix_f.loc[i, 'User-ID'])
-            items_left.add(old_matrix_f.loc[i, 'ISBN'])
-            ratings += 1
-    new_matrix_f.close()
+    valid_ratings = old_matrix_f['ISBN'].isin(list(isbn_to_idx)) & old_matrix_f['User-ID'].isin(list(user_dict)) & \
+        (old_matrix_f['Book-Rating'] != 0)
+    old_matrix_f = old_matrix_f[valid_ratings]
+    new_matrix_f = pd.DataFrame({'User_Idx': old_matrix_f['User-ID'].map(user_dict).values,
+                                 'Book_Idx': old_matrix_f['ISBN'].map(isbn_to_idx).values,
+                                 'Book-Rating': old_matrix_f['Book-Rating'].values},
+                                columns=['User_Idx', 'Book_Idx', 'Book-Rating'])
+    new_matrix_f.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_new.csv'), index=False)
     with open(os.path.join('data', 'book_crossing_edited', 'user_dictionary.csv'), 'w') as f1:
         w1 = csv.DictWriter(f1, user_dict)
         w1.writeheader()
@@ -643,190 +587,303 @@ def edit_book_files():
     user_matrix = pd.read_csv(os.path.join('data', 'book_crossing_edited', 'BX-Users_new.csv'))
     book_matrix = pd.read_csv(os.path.join('data', 'book_crossing_edited', 'BX-Books_new.csv'))
     rating_matrix = pd.read_csv(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_new.csv'))
-    filtered_user_mat = pd.DataFrame(columns=user_matrix.columns)
-    filtered_books_mat = pd.DataFrame(columns=book_matrix.columns)
-    filtered_rating_mat = pd.DataFrame(columns=rating_matrix.columns)
     previous_book_count = float(len(np.unique(book_matrix['ISBN'])))
 
-    remaining_users = set()
-    ratings_count = 0
-    counts = {u: 0 for u in np.unique(rating_matrix['User_Idx'])}
-    for _, row in rating_matrix.iterrows():
-        counts[row.loc['User_Idx']] += 1. / previous_book_count
-        if counts[row.loc['User_Idx']] > 0.00005:
-            remaining_users.add(row.loc['User_Idx'])
-            ratings_count += 1
-            filtered_rating_mat = filtered_rating_mat.append(row, ignore_index=True)
+    # a rating is kept once its user has rated more than 0.00005 of the books (counting in file order)
+    user_fraction = (rating_matrix.groupby('User_Idx').cumcount() + 1) / previous_book_count
+    filtered_rating_mat = rating_matrix[user_fraction > 0.00005]
+    remaining_users = np.unique(filtered_rating_mat['User_Idx'])
     remaining_books = np.unique(filtered_rating_mat['Book_Idx'])
+    ratings_count = filtered_rating_mat.shape[0]
     print("Valid users: ", len(remaining_users))
     print("Valid books: ", len(remaining_books))
     filtered_rating_mat.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_filtered.csv'), index=False)
 
-    for _, row in user_matrix.iterrows():
-        if row.loc['User-ID'] in remaining_users:
-            filtered_user_mat = filtered_user_mat.append(row, ignore_index=True)
+    # the users file keeps float ids ("133.0"), as written by the former row-wise DataFrame.append
+    filtered_user_mat = user_matrix[user_matrix['User-ID'].isin(remaining_users)].astype(np.float64)
     filtered_user_mat.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Users_filtered.csv'), index=False)
 
-    for _, row in book_matrix.iterrows():
-        if row.loc['ISBN'] in remaining_books:
-            filtered_books_mat = filtered_books_mat.append(row, ignore_index=True)
+    filtered_books_mat = book_matrix[book_matrix['ISBN'].isin(remaining_books)]
     filtered_books_mat.to_csv(os.path.join('data', 'book_crossing_edited', 'BX-Books_filtered.csv'), index=False)
 
     print("Total ratings: ", ratings_count)
 
 
-def load_data_books(testing=False):
-    if not os.path.exists(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_filtered.csv')):
-        edit_book_files()
-    dtypes = {
-        'u_nodes': np.int32, 'v_nodes': np.str,
-        'ratings': np.int32}
+def load_pickle_cache(cache_path):
+    """
+    Loads a pickled cache file. Returns None if the file is missing or cannot be unpickled (e.g. it was truncated),
+    in which case the cache is rebuilt by the caller.
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as f:
+            return pkl.load(f)
+    except Exception:
+        return None
+
+
+def dump_pickle_cache(obj, cache_path):
+    """
+    Pickles obj to a temporary file and renames it to cache_path, so that an interrupted dump never leaves
+    a truncated cache file behind.
+    """
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pkl.dump(obj, f, protocol=pkl.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # on Windows os.rename does not replace an existing file
+        os.remove(cache_path)
+        os.rename(tmp_path, cache_path)
 
-    matrix_source = np.array(pd.read_csv(open(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_filtered.csv'),
-                                              'r')))
 
-    np.random.seed(42)
-    test_indices = np.random.choice(np.arange(matrix_source.shape[0]), matrix_source.shape[0] // 10, replace=False)
-    mask = np.array([(i in test_indices) for i in np.arange(matrix_source.shape[0])])
+def read_csv_cached(csv_path, **kwargs):
+    """
+    Reads a csv file with pd.read_csv(csv_path, **kwargs), caching the parsed data frame as a pickle next to it.
+    The cache file name holds a hash of the read arguments, and the cache is used as long as it is newer than
+    the csv file.
+    """
+    args_key = hashlib.md5(repr(sorted(kwargs.items())).encode('utf-8')).hexdigest()[:12]
+    cache_path = '%s.%s.pkl' % (csv_path, args_key)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        df = load_pickle_cache(cache_path)
+        if df is not None:
+            return df
 
-    data_train = matrix_source[~mask, :]
-    data_test = matrix_source[mask, :]
+    df = pd.read_csv(csv_path, **kwargs)
+    dump_pickle_cache(df, cache_path)
+    return df
 
-    data_array_train = data_train.tolist()
-    data_array_train = np.array(data_array_train)
-    data_array_test = data_test.tolist()
-    data_array_test = np.array(data_array_test)
 
-    data_array = np.concatenate([data_array_train, data_array_test], axis=0)
+def lookup_ids(id_dict, ids):
+    """
+    Looks up an array of ids in a dictionary of ids (as returned by map_data) with a binary search
+    over its sorted keys.
+    Returns a mask of the ids that are keys of the dictionary and the mapped values of those ids.
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'O':
+        ids = np.array(ids.tolist())
+
+    # keys and values are iterated in the same order
+    keys = np.array(list(id_dict))
+    if len(id_dict) == 0 or (keys.dtype.kind in 'SU') != (ids.dtype.kind in 'SU'):
+        # as with dictionary lookups, string ids never match numeric keys and vice versa
+        return np.zeros(ids.shape[0], dtype=bool), np.zeros(0, dtype=np.int64)
+    values = np.fromiter(id_dict.values(), dtype=np.int64, count=len(id_dict))
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+    if keys.dtype.kind in 'SU':
+        # string ids are compared at their full length, not truncated to the length of the keys
+        ids = ids.astype(keys.dtype.type)
+
+    pos = np.searchsorted(keys, ids)
+    pos[pos == keys.shape[0]] = 0
+    found = keys[pos] == ids
+    return found, values[pos[found]]
+
+
+def build_v_features(v_dict, num_items):
+    """
+    Builds the book-crossing item features: normalized year of publication and author (binary by name).
+    """
+    # missing authors are read as ''
+    book_df = read_csv_cached(os.path.join('data', 'book_crossing_edited', 'BX-Books_filtered.csv'), engine='c',
+                              usecols=['ISBN', 'Book-Author', 'Year-Of-Publication'], na_filter=False,
+                              dtype={'ISBN': np.int64, 'Book-Author': np.str, 'Year-Of-Publication': np.int32})
+
+    # author codes index the author categories, the author columns start after the year column
+    authors = pd.Categorical(book_df['Book-Author'].values)
+    num_authors = len(authors.categories)
+    year = book_df['Year-Of-Publication'].values
+    year_max = year.max()
 
-    u_nodes_ratings = data_array[:, 0].astype(dtypes['u_nodes'])
-    v_nodes_ratings = data_array[:, 1].astype(dtypes['v_nodes'])
-    ratings = data_array[:, 2].astype(dtypes['ratings'])
+    num_book_feats = 1 + num_authors  # Year of publication (normed), Author (binary by name).
 
-    u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
-    v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
+    # check if book_id was listed in ratings file and therefore in mapping dictionary
+    listed, v_rows = lookup_ids(v_dict, book_df['ISBN'].values)
+    book_df = book_df[listed]
 
-    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int64), v_nodes_ratings.astype(np.int32)
-    ratings = ratings.astype(np.int32)
+    num_listed = v_rows.shape[0]
 
-    u_nodes = u_nodes_ratings
-    v_nodes = v_nodes_ratings
+    # year (column 0) and author (binary, one column per author)
+    v_data = np.concatenate([book_df['Year-Of-Publication'].values.astype(np.float32) / np.float32(year_max),
+                             np.ones(num_listed, dtype=np.float32)])
+    v_cols = np.concatenate([np.zeros(num_listed, dtype=np.int64),
+                             authors.codes[listed].astype(np.int64) + 2])
+    v_features = sp.coo_matrix((v_data, (np.tile(v_rows, 2), v_cols)),
+                               shape=(num_items, num_book_feats), dtype=np.float32).tocsr()
+    # books with an unknown year have a stored year value of zero
+    v_features.eliminate_zeros()
 
-    neutral_rating = -1  # int(np.ceil(np.float(num_classes)/2.)) - 1
+    return v_features
 
-    # assumes that ratings_train contains at least one example of every rating type
-    rating_dict = {r: i for i, r in enumerate(np.sort(np.unique(ratings)).tolist())}
 
-    labels = np.full((num_users, num_items), neutral_rating, dtype=np.int32)
-    labels[u_nodes, v_nodes] = np.array([rating_dict[r] for r in ratings])
+def build_u_features(u_dict, num_users):
+    """
+    Builds the book-crossing user features: normalized age.
+    """
+    users_df = read_csv_cached(os.path.join('data', 'book_crossing_edited', 'BX-Users_filtered.csv'), engine='c',
+                               usecols=['User-ID', 'Age'], dtype={'User-ID': np.float64, 'Age': np.float32})
+
+    age = users_df['Age'].values
+    age_max = age.max()
+
+    listed, u_rows = lookup_ids(u_dict, users_df['User-ID'].values)
+    users_df = users_df[listed]
 
-    for i in range(len(u_nodes)):
-        assert (labels[u_nodes[i], v_nodes[i]] == rating_dict[ratings[i]])
+    u_features = sp.csr_matrix((users_df['Age'].values / np.float32(age_max), (u_rows, np.zeros_like(u_rows))),
+                               shape=(num_users, 1), dtype=np.float32)
 
-    labels = labels.reshape([-1])
+    return u_features
 
-    # number of test and validation edges, see cf-nade code
 
-    num_train = data_array_train.shape[0]
-    num_test = data_array_test.shape[0]
-    num_val = int(np.ceil(num_train * 0.2))
-    num_train = num_train - num_val
+def split_books_ratings(u_nodes, v_nodes, ratings, num_train_ratings, num_test, num_users, num_items,
+                        testing=False):
+    """
+    Splits the ratings of load_data_books, the first num_train_ratings ratings are split into training and
+    validation sets and the last num_test ratings are the test set.
+    """
+    # assumes that ratings_train contains at least one example of every rating type
+    class_values = np.sort(pd.unique(ratings))
+
+    # labels[k] is the class of the rating given by user u_nodes[k] to item v_nodes[k]
+    labels = np.searchsorted(class_values, ratings).astype(np.int32)
+
+    # number of test and validation edges, see cf-nade code
 
-    pairs_nonzero = np.array([[u, v] for u, v in zip(u_nodes, v_nodes)])
-    idx_nonzero = np.array([u * num_items + v for u, v in pairs_nonzero])
+    num_val = int(np.ceil(num_train_ratings * 0.2))
+    num_train = num_train_ratings - num_val
 
-    for i in range(len(ratings)):
-        assert (labels[idx_nonzero[i]] == rating_dict[ratings[i]])
+    pairs_nonzero = np.column_stack([u_nodes, v_nodes])
 
-    idx_nonzero_train = idx_nonzero[0:num_train + num_val]
-    idx_nonzero_test = idx_nonzero[num_train + num_val:]
+    if __debug__:
+        # every (user, item) pair carries a single rating
+        idx_nonzero = np.multiply(u_nodes, num_items, dtype=np.int64) + v_nodes
+        assert np.unique(idx_nonzero).shape[0] == idx_nonzero.shape[0]
 
     pairs_nonzero_train = pairs_nonzero[0:num_train + num_val]
     pairs_nonzero_test = pairs_nonzero[num_train + num_val:]
 
+    labels_train = labels[0:num_train + num_val]
+    labels_test = labels[num_train + num_val:]
+
     # Internally shuffle training set (before splitting off validation set)
-    rand_idx = range(len(idx_nonzero_train))
-    np.random.seed(42)
-    np.random.shuffle(rand_idx)
-    idx_nonzero_train = idx_nonzero_train[rand_idx]
+    rand_idx = np.random.RandomState(42).permutation(len(pairs_nonzero_train))
     pairs_nonzero_train = pairs_nonzero_train[rand_idx]
+    labels_train = labels_train[rand_idx]
 
-    idx_nonzero = np.concatenate([idx_nonzero_train, idx_nonzero_test], axis=0)
     pairs_nonzero = np.concatenate([pairs_nonzero_train, pairs_nonzero_test], axis=0)
-
-    val_idx = idx_nonzero[0:num_val]
-    train_idx = idx_nonzero[num_val:num_train + num_val]
-    test_idx = idx_nonzero[num_train + num_val:]
-
-    assert (len(test_idx) == num_test)
+    labels = np.concatenate([labels_train, labels_test], axis=0)
 
     val_pairs_idx = pairs_nonzero[0:num_val]
     train_pairs_idx = pairs_nonzero[num_val:num_train + num_val]
     test_pairs_idx = pairs_nonzero[num_train + num_val:]
 
+    if __debug__:
+        # the test slice holds exactly the held-out test pairs
+        assert len(test_pairs_idx) == num_test
+
     u_test_idx, v_test_idx = test_pairs_idx.transpose()
     u_val_idx, v_val_idx = val_pairs_idx.transpose()
     u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # create labels
-    train_labels = labels[train_idx]
-    val_labels = labels[val_idx]
-    test_labels = labels[test_idx]
+    val_labels = labels[0:num_val]
+    train_labels = labels[num_val:num_train + num_val]
+    test_labels = labels[num_train + num_val:]
 
     if testing:
-        u_train_idx = np.hstack([u_train_idx, u_val_idx])
-        v_train_idx = np.hstack([v_train_idx, v_val_idx])
-        train_labels = np.hstack([train_labels, val_labels])
-        # for adjacency matrix construction
-        train_idx = np.hstack([train_idx, val_idx])
+        # training pairs followed by the validation pairs, a single copy of each array
+        train_pairs_idx = np.concatenate([train_pairs_idx, val_pairs_idx], axis=0)
+        train_labels = np.concatenate([train_labels, val_labels], axis=0)
+        u_train_idx, v_train_idx = train_pairs_idx.transpose()
 
     # make training adjacency matrix
-    rating_mx_train = np.zeros(num_users * num_items, dtype=np.float32)
-    rating_mx_train[train_idx] = labels[train_idx].astype(np.float32) + 1.
-    rating_mx_train = sp.csr_matrix(rating_mx_train.reshape(num_users, num_items))
+    rating_mx_train = sp.csr_matrix((train_labels.astype(np.float32) + 1., (u_train_idx, v_train_idx)),
+                                    shape=(num_users, num_items))
 
-    class_values = np.sort(np.unique(ratings))
+    return rating_mx_train, train_labels, u_train_idx, v_train_idx, val_labels, u_val_idx, v_val_idx, \
+        test_labels, u_test_idx, v_test_idx, class_values
 
-    # Side information features
-    # book features
-    book_df = pd.read_csv(open(os.path.join('data', 'book_crossing_edited', 'BX-Books_filtered.csv'), 'r'))
 
-    author_dict = {f: i for i, f in enumerate(set(book_df['Book-Author'].values.tolist()), start=2)}
-    year = book_df['Year-Of-Publication'].values
-    year_max = year.max()
+def load_data_books(testing=False, datasplit_from_file=False):
+    if not os.path.exists(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_filtered.csv')):
+        edit_book_files()
+
+    # the outputs are cached per value of testing, and only read back if datasplit_from_file is set.
+    # the cache is rebuilt when one of the filtered files or the source of this module or data_utils changes
+    code_digest = hashlib.md5()
+    for func in [load_data_books, map_data]:
+        with open(inspect.getsourcefile(func), 'rb') as f:
+            code_digest.update(f.read())
+    split_key = [code_digest.hexdigest()] + [os.path.getmtime(os.path.join('data', 'book_crossing_edited', f))
+                                             for f in ['BX-Book-Ratings_filtered.csv', 'BX-Books_filtered.csv',
+                                                       'BX-Users_filtered.csv']]
+    datasplit_path = os.path.join('data', 'book_crossing_edited',
+                                  'split_testing.pkl' if testing else 'split_validation.pkl')
+    if datasplit_from_file:
+        cached = load_pickle_cache(datasplit_path)
+        if cached is not None and cached[0] == split_key:
+            print('Reading dataset splits from file...')
+            return cached[1]
+
+    dtypes = {
+        'u_nodes': np.int32, 'v_nodes': np.str,
+        'ratings': np.int32}
 
-    num_book_feats = 1 + len(author_dict)  # Year of publication (normed), Author (binary by name).
+    matrix_source = read_csv_cached(os.path.join('data', 'book_crossing_edited', 'BX-Book-Ratings_filtered.csv'),
+                                    engine='c', dtype=np.int64).values
 
-    v_features = np.zeros((num_items, num_book_feats), dtype=np.float32)
-    for _, row in book_df.iterrows():
-        v_id = row['ISBN']
-        # check if book_id was listed in ratings file and therefore in mapping dictionary
-        if v_id in v_dict.keys():
-            # year
-            v_features[v_dict[v_id], 0] = row['Year-Of-Publication'] / np.float(year_max)
-            # author
-            v_features[v_dict[v_id], author_dict[row['Book-Author']]] = 1.
+    # hold out a random 10% of the ratings as test set, both parts keep the order of the file
+    num_test = matrix_source.shape[0] // 10
+    perm = np.random.RandomState(42).permutation(matrix_source.shape[0])
+    train_rows = np.sort(perm[num_test:])
+    test_rows = np.sort(perm[:num_test])
 
-    # user features
-    users_df = pd.read_csv(open(os.path.join('data', 'book_crossing_edited', 'BX-Users_filtered.csv'), 'r'))
+    data_array = matrix_source[np.concatenate([train_rows, test_rows])]
 
-    age = users_df['Age'].values
-    age_max = age.max()
+    u_nodes_ratings = data_array[:, 0].astype(dtypes['u_nodes'])
+    v_nodes_ratings = data_array[:, 1].astype(dtypes['v_nodes'])
+    ratings = data_array[:, 2].astype(dtypes['ratings'])
+
+    u_nodes_ratings, u_dict, num_users = map_data(u_nodes_ratings)
+    v_nodes_ratings, v_dict, num_items = map_data(v_nodes_ratings)
 
-    u_features = np.zeros((num_users, 1), dtype=np.float32)
-    for _, row in users_df.iterrows():
-        u_id = row['User-ID']
-        if u_id in u_dict.keys():
-            u_features[u_dict[u_id], 0] = row['Age'] / np.float(age_max)
+    u_nodes_ratings, v_nodes_ratings = u_nodes_ratings.astype(np.int32), v_nodes_ratings.astype(np.int32)
+    ratings = ratings.astype(np.int32)
 
-    u_features = sp.csr_matrix(u_features)
-    v_features = sp.csr_matrix(v_features)
+    # the side information features only depend on the id mappings, they are built while the ratings are split
+    pool = ThreadPool(2)
+    try:
+        v_features_result = pool.apply_async(build_v_features, (v_dict, num_items))
+        u_features_result = pool.apply_async(build_u_features, (u_dict, num_users))
+        pool.close()
+
+        rating_mx_train, train_labels, u_train_idx, v_train_idx, val_labels, u_val_idx, v_val_idx, \
+            test_labels, u_test_idx, v_test_idx, class_values = \
+            split_books_ratings(u_nodes_ratings, v_nodes_ratings, ratings, train_rows.shape[0], num_test,
+                                num_users, num_items, testing)
+
+        # Side information features
+        v_features = v_features_result.get()
+        u_features = u_features_result.get()
+    finally:
+        # a ThreadPool cannot stop running builds, if the split failed this waits for them to finish
+        # before the error is raised
+        pool.terminate()
+        pool.join()
 
     print("User features shape: " + str(u_features.shape))
     print("Item features shape: " + str(v_features.shape))
 
-    return u_features, v_features, rating_mx_train, train_labels, u_train_idx, v_train_idx, \
-           val_labels, u_val_idx, v_val_idx, test_labels, u_test_idx, v_test_idx, class_values
+    split = (u_features, v_features, rating_mx_train, train_labels, u_train_idx, v_train_idx,
+             val_labels, u_val_idx, v_val_idx, test_labels, u_test_idx, v_test_idx, class_values)
+    dump_pickle_cache([split_key, split], datasplit_path)
+
+    return split
 
 
 if __name__ == "__main__":
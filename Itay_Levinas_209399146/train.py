@@ -157,7 +157,7 @@ elif DATASET == 'ml_100k':
 elif DATASET == 'book_crossing':
     u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
       val_labels, val_u_indices, val_v_indices, test_labels, \
-      test_u_indices, test_v_indices, class_values = load_data_books(TESTING)
+      test_u_indices, test_v_indices, class_values = load_data_books(TESTING, SPLITFROMFILE)
 else:
     print("Using random dataset split ...")
     u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
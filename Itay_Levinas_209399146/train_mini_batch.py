@@ -137,7 +137,7 @@ elif DATASET == 'ml_100k':
 else:
     u_features, v_features, adj_train, train_labels, train_u_indices, train_v_indices, \
     val_labels, val_u_indices, val_v_indices, test_labels, \
-    test_u_indices, test_v_indices, class_values = load_data_books(TESTING)
+    test_u_indices, test_v_indices, class_values = load_data_books(TESTING, SPLITFROMFILE)
 
 
 